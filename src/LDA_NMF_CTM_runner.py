@@ -14,6 +14,8 @@ from octis.models.NMF import NMF
 from sentence_transformers import SentenceTransformer
 from sklearn.model_selection import train_test_split
 
+nltk.download('punkt')  # Needed by word_tokenize
+
 EMBEDDING_DIR_PATH = './pretrained_models'
 HUGGING_FACE_EMBEDDING_MODELS = ['bert-base-nli-mean-tokens', "all-mpnet-base-v2", "all-distilroberta-v1",
                                  "all-MiniLM-L12-v2", "all-MiniLM-L6-v2", 'paraphrase-multilingual-MiniLM-L12-v2']
@@ -4,6 +4,7 @@ from collections import OrderedDict, Counter
 from typing import Dict
 
 import keras
+import nltk
 import numpy as np
 import pandas as pd
 from bertopic import BERTopic
@@ -18,6 +19,8 @@ from sklearn.cluster import KMeans
 from sklearn.model_selection import train_test_split
 from umap import UMAP
 
+nltk.download('punkt')  # Needed by word_tokenize
+
 EMBEDDING_DIR_PATH = './pretrained_models'
 HUGGING_FACE_EMBEDDING_MODELS = ["all-mpnet-base-v2", "all-distilroberta-v1",
                                  "all-MiniLM-L12-v2", "all-MiniLM-L6-v2", 'paraphrase-multilingual-MiniLM-L12-v2']
@@ -20,7 +20,8 @@ def main_runner(config: Dict):
 
     docs, labels = load_documents(dataset=config['dataset'])
     if 'preprocessing_funcs' in config:
-        docs = preprocessor.run(data=docs, prep_functions=config['preprocessing_funcs'])
+        docs = preprocessor.run(data=docs, prep_functions=config['preprocessing_funcs'],
+                                use_spacy=config.get('preprocessing_use_spacy', False))
 
     algorithm_args.update(data_name=config['dataset'], docs=docs, labels=labels)
     print(f'[INFO] Running with {algorithm_args["num_topics"]} topics.')
@@ -1,37 +1,47 @@
+import atexit
+import itertools
+import multiprocessing
 import pprint
 import re
 import time
 import types
 import unicodedata
 import unittest
-from functools import reduce
+from functools import lru_cache, partial
 from typing import List, Tuple
 
-import contractions
 import nltk
 import pkg_resources
 from nltk import RegexpTokenizer, WordNetLemmatizer
 from nltk.corpus import stopwords
 from symspellpy import SymSpell, Verbosity
 
-nltk.download('stopwords')
-nltk.download('wordnet')
-nltk.download('omw-1.4')
-nltk.download('punkt')
+tokenizer = RegexpTokenizer(r'[a-zA-Z]+')
 
-sym_spell = SymSpell(max_dictionary_edit_distance=3, prefix_length=7)  # Setup SymSpell for typo correction
+_POOL = None  # Persistent preprocessing pool, see __get_pool()
+_STOP_WORDS = None  # Loaded on first use, see __get_stop_words()
+_LEMMATIZER = None  # Loaded on first use, see __get_lemmatizer()
+_CONTRACTIONS = None  # Imported on first use, see __get_contractions()
+_SYM_SPELL = None  # Loaded on first use, see __get_sym_spell()
+# Spawning the pool costs ~0.35 s (each worker re-imports this module), about what ~20K tweets take serially
+MIN_DOCS_FOR_MULTIPROCESSING = 20_000
 
-if not sym_spell.word_count:
-    dictionary_path = pkg_resources.resource_filename("symspellpy", "frequency_dictionary_en_82_765.txt")
-    sym_spell.load_dictionary(dictionary_path, term_index=0, count_index=1)
+_URL_RE = re.compile(r'https?\S+')
+_WWW_RE = re.compile(r'www\S+')
+_MISSING_DELIMITER_RE = re.compile(r'([a-z])([A-Z])')
+_MENTION_RE = re.compile(r'@\S*')
+_HASHTAG_RE = re.compile(r'#\S*')
+_NON_ALPHABET_RE = re.compile(r'[^a-zA-Z]')
+_NON_ALPHABET_TABLE = {code: ' ' for code in range(128) if not chr(code).isalpha()}
+_NEW_LINE_RE = re.compile(r"\\n")
+_HTML_TAG_RE = re.compile(r'<.*?>')
 
-english_stop_words = set(stopwords.words('english'))
-lemmatizer = WordNetLemmatizer()
-tokenizer = RegexpTokenizer(r'[a-zA-Z]+')
+LEMMATIZE_POS_TAGS = {'lemmatize': 'n', 'lemmatize_verb': 'v', 'lemmatize_noun': 'n', 'lemmatize_adjective': 'a'}
 
 
-def list_available_prep_functions(exclude: Tuple[str] = ('run', 'list_available_prep_functions')):
+def list_available_prep_functions(exclude: Tuple[str] = ('run', 'list_available_prep_functions', 'run_spacy')):
     available_functions = [var for var in globals() if isinstance(globals()[var], types.FunctionType)]
+    available_functions = [func for func in available_functions if globals()[func].__module__ == __name__]  # No imports
     available_functions = [func for func in available_functions if func not in exclude]  # Exclude Passed Funcs
     available_functions = [func for func in available_functions if not func.startswith('__')]  # Exclude Private Funcs
     return available_functions
@@ -57,54 +67,191 @@ def __is_tokenized_method(func_name):
     return func_name.startswith('lemmatize') or func_name in tokenized_function_names
 
 
+def __fuse_tokenized_methods(tokenized_methods):
+    """
+    :param tokenized_methods: tokenized preprocessing method names in order
+    :return: a single fused token pipeline if the methods are an optional stop word removal followed by
+    lemmatizations, otherwise the methods wrapped with tokenization and glueing
+    """
+    drop_stop_words = tokenized_methods[0] == 'remove_english_stop_words'
+    lemmatize_methods = tokenized_methods[1:] if drop_stop_words else tokenized_methods
+    if lemmatize_methods and all(func_name in LEMMATIZE_POS_TAGS for func_name in lemmatize_methods):
+        lemma_pos_chain = tuple(LEMMATIZE_POS_TAGS[func_name] for func_name in lemmatize_methods)
+        return [partial(__fused_token_pipeline, lemma_pos_chain=lemma_pos_chain, drop_stop_words=drop_stop_words)]
+    # The whole group is wrapped once, so consecutive tokenized methods share one token list without re-tokenizing
+    return ['__tokenize'] + list(tokenized_methods) + ['__glue']
+
+
+def __resolve_method(func): return globals()[func] if isinstance(func, str) else func
+
+
+def __compile_pipeline(str_funcs: List[str], tokenized_funcs: List[str]) -> Tuple[Tuple, Tuple]:
+    """
+    Fuses the given methods where possible and resolves them to callables once, so that the pipeline applied to each
+    document does not look functions up by name.
+    :param str_funcs: string preprocessing method names in order
+    :param tokenized_funcs: tokenized preprocessing method names in order
+    :return: string method callables and tokenized method callables, both in the order they are applied
+    """
+    if tokenized_funcs:
+        tokenized_funcs = __fuse_tokenized_methods(tokenized_funcs)
+    assert tokenized_funcs.count('__tokenize') <= 1, f'Tokenized methods must be tokenized once:{tokenized_funcs}.'
+    return tuple(map(__resolve_method, str_funcs)), tuple(map(__resolve_method, tokenized_funcs))
+
+
+def __method_name(func) -> str:
+    """
+    :param func: compiled preprocessing method
+    :return: method name, fused methods are named after the methods they replace, in the order they are applied
+    """
+    if not isinstance(func, partial):
+        return func.__name__
+    step_names = ['remove_english_stop_words'] if func.keywords['drop_stop_words'] else []  # __fused_token_pipeline
+    step_names += [f"lemmatize(pos='{pos}')" for pos in func.keywords['lemma_pos_chain']]
+    return f'{func.func.__name__}({", ".join(step_names)})'
+
+
+def __load_nltk_resource(load, *resource_names):
+    """
+    Downloads the NLTK resources only if loading them fails, instead of checking them with the server on every import.
+    :param load: function loading the resources
+    :param resource_names: NLTK resources to download if they are missing
+    :return: what load returns
+    """
+    try:
+        return load()
+    except LookupError:
+        for resource_name in resource_names:
+            nltk.download(resource_name)
+        return load()
+
+
+def __get_stop_words():
+    global _STOP_WORDS
+    if _STOP_WORDS is None:
+        _STOP_WORDS = __load_nltk_resource(lambda: frozenset(stopwords.words('english')), 'stopwords')
+    return _STOP_WORDS
+
+
+def __load_lemmatizer():
+    lemmatizer = WordNetLemmatizer()
+    lemmatizer.lemmatize('test', 'n')  # WordNet corpus is loaded on the first call, so trigger it here
+    return lemmatizer
+
+
+def __get_lemmatizer():
+    global _LEMMATIZER
+    if _LEMMATIZER is None:
+        _LEMMATIZER = __load_nltk_resource(__load_lemmatizer, 'wordnet', 'omw-1.4')
+    return _LEMMATIZER
+
+
+def __get_contractions():
+    global _CONTRACTIONS
+    if _CONTRACTIONS is None:
+        import contractions
+        _CONTRACTIONS = contractions
+    return _CONTRACTIONS
+
+
+def __get_sym_spell():
+    global _SYM_SPELL
+    if _SYM_SPELL is None:  # Loading the dictionary takes seconds, so only pipelines with correct_typo pay for it
+        _SYM_SPELL = SymSpell(max_dictionary_edit_distance=3, prefix_length=7)  # Setup SymSpell for typo correction
+        dictionary_path = pkg_resources.resource_filename("symspellpy", "frequency_dictionary_en_82_765.txt")
+        _SYM_SPELL.load_dictionary(dictionary_path, term_index=0, count_index=1)
+    return _SYM_SPELL
+
+
+def __warmup(tokenized_methods: Tuple):
+    """Loads only the heavy resources the given compiled tokenized methods use, so that a missing one fails early."""
+    for func in tokenized_methods:
+        if isinstance(func, partial):  # Fused stop word removal and lemmatization, see __fuse_tokenized_methods()
+            if func.keywords['drop_stop_words']:
+                __get_stop_words()
+            __get_lemmatizer()
+        elif func is remove_english_stop_words:
+            __get_stop_words()
+        elif func.__name__ in LEMMATIZE_POS_TAGS:
+            __get_lemmatizer()
+        elif func is expand_contractions:
+            __get_contractions()
+        elif func is correct_typo:
+            __get_sym_spell()
+
+
 def __tokenize(s): return tokenizer.tokenize(s)
 
 
-def __glue(words): return ' '.join(words).strip()
+def __glue(words): return ' '.join(words)  # Tokens never contain whitespace, so no stripping is needed
 
 
 def to_lowercase(text): return text.lower()
 
 
 def standardize_accented_chars(text):
-    return unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode('utf-8', 'ignore')
+    if text.isascii():  # NFKD leaves ASCII unchanged, skip normalizing and re-encoding
+        return text
+    return unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode('ascii')
 
 
-def remove_url(text):
-    text = re.sub(r'https?\S+', '', text)
-    return re.sub(r'www\S+', '', text)
+def remove_url(text): return _WWW_RE.sub('', _URL_RE.sub('', text))
 
 
-def expand_missing_delimiter(text): return re.sub(r'([a-z])([A-Z])', r'\1 \2', text)
+def expand_missing_delimiter(text): return _MISSING_DELIMITER_RE.sub(r'\1 \2', text)
 
 
-def remove_mentions(text): return re.sub(r'@\S*', '', text)
+def remove_mentions(text): return _MENTION_RE.sub('', text)
 
 
-def remove_hashtags(text): return re.sub(r'#\S*', '', text)
+def remove_hashtags(text): return _HASHTAG_RE.sub('', text)
 
 
-def keep_only_alphabet(text): return re.sub(r'[^a-zA-Z]', ' ', text)
+def keep_only_alphabet(text):
+    if text.isascii():  # Translation table covers ASCII only, the regex handles the rest
+        return text.translate(_NON_ALPHABET_TABLE)
+    return _NON_ALPHABET_RE.sub(' ', text)
 
 
-def remove_new_lines(text): return re.sub(r"\\n", " ", text)
+def remove_new_lines(text): return _NEW_LINE_RE.sub(' ', text)
 
 
-def remove_extra_spaces(text): return ' '.join(text.split())
+def remove_extra_spaces(text): return ' '.join(text.split())  # ~3x faster than re.sub(r'\s+', ' ', text).strip()
 
 
-def remove_html_tags(text): return re.sub(r'<.*?>', ' ', text)
+def remove_html_tags(text): return _HTML_TAG_RE.sub(' ', text)
 
 
-def expand_contractions(tokenized_text: List[str]): return [contractions.fix(word) for word in tokenized_text]
+@lru_cache(maxsize=200_000)
+def __fix_contraction(word): return __get_contractions().fix(word)
+
+
+def expand_contractions(tokenized_text: List[str]): return [__fix_contraction(word) for word in tokenized_text]
 
 
 def remove_english_stop_words(tokenized_text: List[str]):
-    return list(filter(lambda word: word not in english_stop_words, tokenized_text))
+    english_stop_words = __get_stop_words()
+    return [word for word in tokenized_text if word not in english_stop_words]
+
+
+@lru_cache(maxsize=500_000)
+def __lemma(word, pos): return __get_lemmatizer().lemmatize(word, pos)
+
+
+def __fused_token_pipeline(text, lemma_pos_chain: Tuple[str], drop_stop_words: bool):
+    english_stop_words = __get_stop_words()
+    words = []
+    for word in tokenizer.tokenize(text):
+        if drop_stop_words and word in english_stop_words:
+            continue
+        for pos in lemma_pos_chain:
+            word = __lemma(word, pos)
+        words.append(word)
+    return ' '.join(words)
 
 
 def lemmatize(tokenized_text: List[str], pos='n'):
-    return [lemmatizer.lemmatize(word, pos) for word in tokenized_text]
+    return [__lemma(word, pos) for word in tokenized_text]
 
 
 def lemmatize_verb(tokenized_text: List[str]):
@@ -124,6 +271,7 @@ def correct_typo(tokenized_text: List[str]):
     :param tokenized_text: word list to be processed
     :return: word list with typo fixed by symspell. words with no match up will be returned as they are
     """
+    sym_spell = __get_sym_spell()
     w_list_fixed = []
     for word in tokenized_text:
         suggestions = sym_spell.lookup(word, Verbosity.CLOSEST, max_edit_distance=3)
@@ -152,6 +300,9 @@ class TestUtils(unittest.TestCase):
         str_before = 'using https://www.google.com/ as an example'
         str_after = 'using  as an example'
         self.assertTrue(str_after == remove_url(str_before))
+        # http(s) URLs are removed before www ones, so a "www" in front of an http URL is kept
+        self.assertTrue('www foo' == remove_url('wwwhttps://x foo'))
+        self.assertTrue('www ' == remove_mentions(remove_url('wwwhttp://a @b')))
 
         # expand_contractions
         str_before = "Don't is the same as do not"
@@ -203,25 +354,85 @@ class TestUtils(unittest.TestCase):
         str_after = "Hello this is a natural language problem"
         self.assertTrue(str_after == correct_typo(tokenizer.tokenize(str_before)))
 
-
-def __instance_preprocess(a_str: str, str_methods: Tuple[str], tokenized_methods: Tuple[str] = None) -> str:
-    a_str = reduce(lambda res, func: globals()[func](res), str_methods, a_str)
+    def test_glue(self):
+        glue = globals()['__glue']  # Module private names are mangled inside the class body, so look it up
+
+        str_before = '  Leading, trailing   and\n repeated spaces!  '
+        str_after = 'Leading trailing and repeated spaces'
+        self.assertTrue(str_after == glue(tokenizer.tokenize(str_before)))
+        self.assertTrue('' == glue(tokenizer.tokenize('  !!  ')))
+
+    def test_compile_pipeline(self):
+        split_on_condition = globals()['__split_iterable_on_condition']
+        is_tokenized_method = globals()['__is_tokenized_method']
+        compile_pipeline = globals()['__compile_pipeline']
+        tokenize, glue = globals()['__tokenize'], globals()['__glue']
+
+        # Tokenized methods are grouped and wrapped by a single tokenization, even when interleaved
+        prep_functions = ['to_lowercase', 'correct_typo', 'remove_url', 'lemmatize_verb', 'lemmatize_noun']
+        tokenized_funcs, str_funcs = split_on_condition(is_tokenized_method, iterable=prep_functions)
+        str_methods, tokenized_methods = compile_pipeline(str_funcs=str_funcs, tokenized_funcs=tokenized_funcs)
+        self.assertTrue(str_methods == (to_lowercase, remove_url))
+        self.assertTrue(tokenized_methods == (tokenize, correct_typo, lemmatize_verb, lemmatize_noun, glue))
+
+        # Stop word removal followed by lemmatizations is fused into one pass with the same output
+        str_before = 'The cats were running and jumping over the walls, happier than ever.'
+        tokenized_funcs = ['remove_english_stop_words', 'lemmatize_verb', 'lemmatize_noun', 'lemmatize_adjective']
+        _, tokenized_methods = compile_pipeline(str_funcs=[], tokenized_funcs=tokenized_funcs)
+        self.assertTrue(len(tokenized_methods) == 1)
+        str_after = glue(lemmatize_adjective(lemmatize_noun(lemmatize_verb(
+            remove_english_stop_words(tokenize(str_before))))))
+        self.assertTrue(str_after == tokenized_methods[0](str_before))
+        self.assertTrue(globals()['__method_name'](tokenized_methods[0]) == (
+            "__fused_token_pipeline(remove_english_stop_words, lemmatize(pos='v'), lemmatize(pos='n'), "
+            "lemmatize(pos='a'))"))
+
+
+def __instance_preprocess(a_str: str, str_methods: Tuple, tokenized_methods: Tuple = None) -> str:
+    for func in str_methods:
+        a_str = func(a_str)
     if tokenized_methods:
-        a_str = reduce(lambda res, func: globals()[func](res), tokenized_methods, a_str)
+        for func in tokenized_methods:
+            a_str = func(a_str)
     return a_str
 
 
-def __preprocess(data: List[str], str_methods: Tuple, tokenized_methods: Tuple[str] = None) -> List[str]:
+def __batch_preprocess(batch: List[str], str_methods: Tuple, tokenized_methods: Tuple = None) -> List[str]:
+    return [__instance_preprocess(a_str, str_methods=str_methods, tokenized_methods=tokenized_methods)
+            for a_str in batch]
+
+
+def __get_pool():
+    global _POOL
+    if _POOL is None:  # Created once and reused, so repeated runs do not pay the worker startup cost again
+        # spawn instead of fork, since TensorFlow, torch or numba threads may already be running in this process
+        _POOL = multiprocessing.get_context('spawn').Pool(processes=multiprocessing.cpu_count())
+    return _POOL
+
+
+@atexit.register
+def __close_pool():
+    if _POOL is not None:
+        _POOL.close()
+        _POOL.join()
+
+
+def __preprocess(data: List[str], str_methods: Tuple, tokenized_methods: Tuple = None) -> List[str]:
     print(f'[INFO] [PREPROCESSOR] These string preprocessing methods will be applied to the data in order:')
-    pprint.pprint(str_methods, indent=3, width=40)
+    pprint.pprint([__method_name(func) for func in str_methods], indent=3, width=40)
     if tokenized_methods:
         print(f'[INFO] [PREPROCESSOR] Then, these tokenized preprocessing methods will be applied in order:')
-        pprint.pprint(tokenized_methods, indent=3, width=40)
-    # with get_context("spawn").Pool(processes=multiprocessing.cpu_count()) as pool:
-    #  x = pool.map(partial(__instance_preprocess, str_methods=str_methods, tokenized_methods=tokenized_methods), data)
+        pprint.pprint([__method_name(func) for func in tokenized_methods], indent=3, width=40)
+
+    # Starting the pool and IPC would cost more than the preprocessing itself, as for lowercasing alone
+    if len(data) < MIN_DOCS_FOR_MULTIPROCESSING or (str_methods == (to_lowercase,) and not tokenized_methods):
+        return __batch_preprocess(data, str_methods=str_methods, tokenized_methods=tokenized_methods)
 
-    x = [__instance_preprocess(a_str, str_methods=str_methods, tokenized_methods=tokenized_methods) for a_str in data]
-    return x
+    batch_size = -(-len(data) // (multiprocessing.cpu_count() * 4))  # Amortize IPC over many docs per message
+    batches = [data[i:i + batch_size] for i in range(0, len(data), batch_size)]
+    x = __get_pool().map(partial(__batch_preprocess, str_methods=str_methods, tokenized_methods=tokenized_methods),
+                         batches)
+    return list(itertools.chain.from_iterable(x))
 
 
 def __check_functions_validity(prep_functions: List[str]):
@@ -232,7 +443,58 @@ def __check_functions_validity(prep_functions: List[str]):
         raise ValueError(f'These functions are not available:{set(prep_functions).difference(all_funcs)}.')
 
 
-def run(data: List[str], prep_functions: List[str]) -> List[str]:
+def __run_with_spacy(data: List[str], str_funcs: List[str], tokenized_funcs: List[str]) -> List[str]:
+    spacy_supported_funcs = set(LEMMATIZE_POS_TAGS) | {'remove_english_stop_words'}
+    if not set(tokenized_funcs).issubset(spacy_supported_funcs):
+        print(f'[ERROR] [PREPROCESSOR] Given tokenized functions:{tokenized_funcs}, '
+              f'supported with spaCy:{spacy_supported_funcs}.')
+        raise ValueError(f'These functions are not supported with spaCy:'
+                         f'{set(tokenized_funcs).difference(spacy_supported_funcs)}.')
+
+    t_0 = time.time()
+    print(f'[INFO] [PREPROCESSOR] Preprocessing with spaCy starting..')
+    if str_funcs:
+        str_methods, _ = __compile_pipeline(str_funcs=str_funcs, tokenized_funcs=[])
+        data = __preprocess(data, str_methods=str_methods)
+    print(f'[INFO] [PREPROCESSOR] Then, these tokenized preprocessing methods will be applied by spaCy:')
+    pprint.pprint(tokenized_funcs, indent=3, width=40)
+    preprocessed_data = run_spacy(data, remove_stop_words='remove_english_stop_words' in tokenized_funcs,
+                                  lemmatize_words=any(func in LEMMATIZE_POS_TAGS for func in tokenized_funcs))
+    print(f'[INFO] [PREPROCESSOR] Preprocessing completed in {round(time.time() - t_0, 3)} seconds..')
+    return preprocessed_data
+
+
+def run_spacy(data: List[str], remove_stop_words: bool = True, lemmatize_words: bool = True,
+              batch_size: int = 1000, n_process: int = 1) -> List[str]:
+    """
+    Tokenizes, removes stop words and lemmatizes the documents in batches with spaCy's nlp.pipe.
+    :param data: documents to be processed
+    :param remove_stop_words: whether to drop spaCy's English stop words (note: not the same list as NLTK's)
+    :param lemmatize_words: whether to replace tokens by their POS-aware lemmas
+    :param batch_size: number of documents buffered per batch
+    :param n_process: number of processes spaCy uses, each one loads its own copy of the model
+    :return: documents as alphabetic tokens glued with single spaces
+    """
+    try:
+        import spacy  # Optional dependency, only needed for this path
+    except ImportError:
+        print(f'[ERROR] [PREPROCESSOR] spaCy is not installed, install it with "pip install spacy" to use spaCy.')
+        raise
+    try:
+        nlp = spacy.load('en_core_web_sm', disable=['parser', 'ner'])  # Tagger is kept, the lemmatizer needs POS tags
+    except OSError:
+        print(f'[ERROR] [PREPROCESSOR] spaCy model "en_core_web_sm" is not found, '
+              f'download it with "python -m spacy download en_core_web_sm".')
+        raise
+    preprocessed_data = []
+    for doc in nlp.pipe(data, batch_size=batch_size, n_process=n_process):
+        words = [token.lemma_ if lemmatize_words else token.text for token in doc
+                 if token.is_alpha and not (remove_stop_words and token.is_stop)]
+        preprocessed_data.append(' '.join(words))
+    return preprocessed_data
+
+
+def run(data: List[str], prep_functions: List[str], use_spacy: bool = False) -> List[str]:
     # os.environ['TOKENIZERS_PARALLELISM'] = 'true'
     if not prep_functions:
         print(f'[WARN] [PREPROCESSOR] Preprocessing functions are empty or None, '
@@ -243,13 +505,15 @@ def run(data: List[str], prep_functions: List[str]) -> List[str]:
     print(f'[INFO] [PREPROCESSOR] Available Preprocessing Functions in the Module:{list_available_prep_functions()}')
 
     tokenized_funcs, str_funcs = __split_iterable_on_condition(__is_tokenized_method, iterable=prep_functions)
-    if tokenized_funcs:
-        tokenized_funcs = ['__tokenize'] + tokenized_funcs + ['__glue']
-    tokenized_funcs, str_funcs = tuple(tokenized_funcs), tuple(str_funcs)
+    if use_spacy and tokenized_funcs:
+        return __run_with_spacy(data, str_funcs=str_funcs, tokenized_funcs=tokenized_funcs)
+    str_methods, tokenized_methods = __compile_pipeline(str_funcs=str_funcs, tokenized_funcs=tokenized_funcs)
 
+    # Loaded in this process first, so that missing NLTK data is downloaded once and not by every pool worker
+    __warmup(tokenized_methods)
     t_0 = time.time()
     print(f'[INFO] [PREPROCESSOR] Preprocessing starting..')
-    preprocessed_data = __preprocess(data, str_methods=str_funcs, tokenized_methods=tokenized_funcs)
+    preprocessed_data = __preprocess(data, str_methods=str_methods, tokenized_methods=tokenized_methods)
     print(f'[INFO] [PREPROCESSOR] Preprocessing completed in {round(time.time() - t_0, 3)} seconds..')
     return preprocessed_data
 
@@ -1,10 +1,15 @@
 import os.path
+import shutil
 import tarfile
 import time
+import unittest
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from multiprocessing import cpu_count
-from typing import List, Dict, Any, Tuple
+from typing import List, Dict, Tuple
 
+import numpy as np
 import pandas as pd
 import requests
 from sentence_transformers import SentenceTransformer
@@ -29,6 +34,40 @@ HUGGING_FACE_EMBEDDING_MODELS = ['distiluse-base-multilingual-cased', 'all-MiniL
 VALID_EMBEDDING_MODELS = ['doc2vec'] + HUGGING_FACE_EMBEDDING_MODELS + TF_HUB_EMBEDDING_MODELS
 
 
+def download_tf_hub_embedding_model(embedding_model: Dict[str, str], embedding_folder: str,
+                                    remove_tar_gz: bool = True) -> None:
+    target_path = f'{embedding_folder}/{embedding_model["name"]}'
+
+    if not os.path.exists(target_path):
+        print(f'[INFO] The embedding model folder:"{target_path}" not found, downloading..')
+        response = requests.get(url=embedding_model["source"], stream=True)
+        response.raise_for_status()
+        if remove_tar_gz:  # Archive is not kept, so extract it while downloading instead of writing it to disk first
+            response.raw.decode_content = True
+            print(f'[INFO] Extracting the embedding model :"{target_path}" while downloading..')
+            try:
+                with tarfile.open(fileobj=response.raw, mode='r|*') as file:
+                    file.extractall(target_path)
+            except BaseException:
+                shutil.rmtree(target_path, ignore_errors=True)  # Otherwise the partial folder is taken as downloaded
+                raise
+            print(f'[INFO] The embedding model folder:"{target_path}" downloaded and extracted.')
+        else:
+            with open(target_path + '.tar.gz', 'wb') as f:
+                for chunk in response.iter_content(chunk_size=1024 * 1024):  # Stream to disk, archives are large
+                    if chunk:
+                        f.write(chunk)
+            print(f'[INFO] The embedding model folder:"{target_path}" downloaded.')
+
+            file = tarfile.open(target_path + '.tar.gz')
+            print(f'[INFO] Extracting the downloaded embedding model :"{target_path}.tar.gz"..')
+            file.extractall(target_path)
+            print(f'[INFO] Extracted the downloaded embedding model :"{target_path}.tar.gz".')
+            file.close()
+    else:
+        print(f'[INFO] The embedding model folder:"{target_path}" found, so no need to download.')
+
+
 def download_embedding_models(embedding_folder: str, remove_tar_gz: bool = True) -> None:
     if not os.path.exists(embedding_folder):
         print(f'[INFO] The embedding folder "{embedding_folder}" download folder was missing, so creating..')
@@ -43,72 +82,79 @@ def download_embedding_models(embedding_folder: str, remove_tar_gz: bool = True)
         else:
             print(f'[INFO] The embedding model folder:"{target_path}" found, so no need to download.')
 
-    for embedding_model in TF_HUB_EMBEDDING_MODELS_WITH_SOURCES:
-        target_path = f'{embedding_folder}/{embedding_model["name"]}'
+    # TF Hub archives are large and downloads are I/O-bound, so fetch them concurrently, each into its own path
+    with ThreadPoolExecutor(max_workers=len(TF_HUB_EMBEDDING_MODELS_WITH_SOURCES)) as executor:
+        list(executor.map(partial(download_tf_hub_embedding_model, embedding_folder=embedding_folder,
+                                  remove_tar_gz=remove_tar_gz), TF_HUB_EMBEDDING_MODELS_WITH_SOURCES))
 
-        if not os.path.exists(target_path):
-            print(f'[INFO] The embedding model folder:"{target_path}" not found, downloading..')
-            response = requests.get(url=embedding_model["source"], stream=True)
-            if response.status_code == 200:
-                with open(target_path + '.tar.gz', 'wb') as f:
-                    f.write(response.raw.read())
-            print(f'[INFO] The embedding model folder:"{target_path}" downloaded.')
 
-            file = tarfile.open(target_path + '.tar.gz')
-            print(f'[INFO] Extracting the downloaded embedding model :"{target_path}.tar.gz"..')
-            file.extractall(target_path)
-            print(f'[INFO] Extracted the downloaded embedding model :"{target_path}.tar.gz".')
-            file.close()
-            if remove_tar_gz:
-                os.remove(path=target_path + '.tar.gz')
-                print(f'[INFO] Deleted the downloaded embedding model archive:"{target_path}.tar.gz".')
-        else:
-            print(f'[INFO] The embedding model folder:"{target_path}" found, so no need to download.')
-
-
-def print_topic_stats(stats: List[Dict[str, Any]]) -> None:
-    for stat in stats:
-        print(f'[INFO] Topic #{str(stat["topic_num"]).zfill(2)}:')
-        print(f'     > From Reduced Model:{stat["reduced"]}.')
-        print(f'     > Topic Size:{stat["topic_size"]}.')
-        print(f'     > Topic Words:', str(stat['topic_words']).replace('\n', '\n\t\t'))
-        print(f'     > Topic Word Scores:', str(stat['word_scores']).replace('\n', '\n\t\t'))
+def print_topic_stats(stats: pd.DataFrame) -> None:
+    for stat in stats.itertuples(index=False):
+        print(f'[INFO] Topic #{str(stat.topic_num).zfill(2)}:')
+        print(f'     > From Reduced Model:{stat.reduced}.')
+        print(f'     > Topic Size:{stat.topic_size}.')
+        print(f'     > Topic Words:', str(stat.topic_words).replace('\n', '\n\t\t'))
+        print(f'     > Topic Word Scores:', str(stat.word_scores).replace('\n', '\n\t\t'))
 
 
-def get_topic_stats(model_t2v: Top2Vec, is_reduced: bool = False) -> List[Dict[str, Any]]:
+def get_topic_stats(model_t2v: Top2Vec, is_reduced: bool = False) -> pd.DataFrame:
     num_topics = model_t2v.get_num_topics(reduced=is_reduced)
     topic_sizes, topic_nums = model_t2v.get_topic_sizes(reduced=is_reduced)
     topic_words, word_scores, _ = model_t2v.get_topics(num_topics=num_topics, reduced=is_reduced)
 
-    stats = []
-    for tn, ts, tw, ws in zip(topic_nums, topic_sizes, topic_words, word_scores):
-        stats.append(OrderedDict([
-            ('reduced', is_reduced),
-            ('topic_num', tn),
-            ('topic_size', ts),
-            ('topic_words', tw),
-            ('word_scores', ws)
-        ]))
-    return stats
+    return pd.DataFrame({
+        'reduced': is_reduced,
+        'topic_num': topic_nums,
+        'topic_size': topic_sizes,
+        'topic_words': list(topic_words),  # One word array per topic, kept as an object column
+        'word_scores': list(word_scores),
+    })
+
+
+def deduplicate_documents(docs: List[str]) -> Tuple[List[str], np.ndarray]:
+    """
+    :param docs: list of documents
+    :return: unique documents in first-occurrence order, and the index of each document in the unique documents
+    """
+    doc2unique_index = {}
+    inverse = np.array([doc2unique_index.setdefault(doc, len(doc2unique_index)) for doc in docs])
+    return list(doc2unique_index), inverse
 
 
-def extract_doc_topic_output(run_id: float, topic_stats: List[Dict], model: Top2Vec,
+def expand_deduplicated_model(model: Top2Vec, docs: List[str], inverse: np.ndarray) -> None:
+    """
+    Maps a Top2Vec model trained on unique documents back to the full corpus, so that each document (including the
+    duplicates) gets its own document id, document vector and topic assignment.
+    The topics themselves are not recomputed: UMAP and HDBSCAN saw each duplicate only once, so a document repeated
+    many times no longer forms a dense cluster on its own and counts once towards min_cluster_size.
+    Only for embedding models with precomputed document vectors, since doc2vec keeps its vectors in model.model.dv.
+    """
+    model.documents = np.array(docs, dtype='object')
+    model.document_ids = np.array(range(0, len(docs)))
+    model.doc_id2index = dict(zip(model.document_ids, range(0, len(docs))))
+    model.document_vectors = model.document_vectors[inverse]
+    model.doc_top, model.doc_dist = model._calculate_documents_topic(model.topic_vectors, model.document_vectors)
+    model.topic_sizes = model._calculate_topic_sizes(hierarchy=False)
+    model._reorder_topics(hierarchy=False)
+
+
+def extract_doc_topic_output(run_id: float, topic_stats: pd.DataFrame, model: Top2Vec,
                              labels: List[str], is_reduced: bool) -> pd.DataFrame:
     doc_topic_outputs = []
-    for topic_stat in topic_stats:
+    for topic_num, topic_size in zip(topic_stats['topic_num'], topic_stats['topic_size']):
         docs, doc_scores, document_ids = model.search_documents_by_topic(
-            topic_num=topic_stat['topic_num'], num_docs=topic_stat['topic_size'], reduced=is_reduced
+            topic_num=topic_num, num_docs=topic_size, reduced=is_reduced
         )
         for doc_id, doc, score in zip(document_ids, docs, doc_scores):
             doc_topic_outputs.append({'run_id': run_id,
                                       'Document ID': doc_id, 'Document': doc, 'Real Label': labels[doc_id],
-                                      'Assigned Topic Num': topic_stat['topic_num'], 'Assignment Score': score})
+                                      'Assigned Topic Num': topic_num, 'Assignment Score': score})
 
     return pd.DataFrame(doc_topic_outputs).sort_values('Document ID')
 
 
 def extract_topic_word_output(
-        run_id: float, topic_stats: List[Dict], method_specific_params: dict, dataset: str,
+        run_id: float, topic_stats: pd.DataFrame, method_specific_params: dict, dataset: str,
         num_topics: int, method: str, num_detected_topics: float, num_final_topics: int, duration_secs: float):
     modeling_params_dict = OrderedDict([
         ('run_id', run_id),
@@ -124,14 +170,18 @@ def extract_topic_word_output(
         ('duration_secs', duration_secs),
     ])
 
-    params_df = pd.DataFrame([modeling_params_dict] * len(topic_stats))
-    results_df = pd.DataFrame([modeling_results_dict] * len(topic_stats))
-    return pd.concat([params_df, pd.DataFrame(topic_stats), results_df], axis=1)
+    # Broadcast the run-level values as columns around the topic stats, instead of concatenating replicated frames
+    df_topic_word = topic_stats.copy()
+    for loc, (column, value) in enumerate(modeling_params_dict.items()):
+        df_topic_word.insert(loc, column, [value] * len(df_topic_word))
+    for column, value in modeling_results_dict.items():
+        df_topic_word[column] = [value] * len(df_topic_word)
+    return df_topic_word
 
 
 def run(data_name: str, docs: List[str], labels: List[str], min_count: int, embedding_model: str, umap_args: Dict,
         hdbscan_args: Dict, run_id: int, doc2vec_speed: str = None, num_topics: int = None,
-        algorithm: str = 'top2vec') -> Tuple:
+        algorithm: str = 'top2vec', dedupe: bool = False) -> Tuple:
     """
     Runs Top2Vec algorithm with the given parameters.
 
@@ -187,12 +237,22 @@ def run(data_name: str, docs: List[str], labels: List[str], min_count: int, embe
 
     num_topics: Given number of topics. If model can reduce the number of topics, it can reduce to num_topics.
     algorithm: Algorithm name, not a hyperparameter
+    dedupe: If True, the model is trained on unique documents only and then mapped back to all documents, so that
+            duplicate documents are embedded once. Note that min_count, UMAP and HDBSCAN (min_cluster_size) then see
+            each duplicate document only once. Not supported for doc2vec.
     """
+    if dedupe and embedding_model == 'doc2vec':
+        raise ValueError('dedupe is not supported for doc2vec, since its document vectors can not be expanded.')
     assert embedding_model in VALID_EMBEDDING_MODELS, f'"{embedding_model}" must be in {VALID_EMBEDDING_MODELS}!'
     download_embedding_models(embedding_folder=EMBEDDING_DIR_PATH)
     time_start = time.time()
     print(f'[INFO] Top2Vec with name:"{algorithm}" is running for dataset:"{data_name}".')
 
+    all_docs = docs
+    if dedupe:
+        docs, inverse = deduplicate_documents(all_docs)
+        print(f'[INFO] Deduplicated documents, training on {len(docs)} unique out of {len(all_docs)} documents.')
+
     if embedding_model == 'doc2vec':  # Model is Doc2Vec
         model = Top2Vec(
             docs, speed=doc2vec_speed, workers=cpu_count(), min_count=min_count,
@@ -213,6 +273,9 @@ def run(data_name: str, docs: List[str], labels: List[str], min_count: int, embe
     else:
         raise ValueError(f'Given "{embedding_model}" not in valid embedding models: {VALID_EMBEDDING_MODELS}.')
 
+    if dedupe and len(docs) < len(all_docs):
+        expand_deduplicated_model(model=model, docs=all_docs, inverse=inverse)
+
     non_reduced_num_topics = model.get_num_topics(reduced=False)
     print(f'[INFO] Original (Non-reduced) Number of Topics: {non_reduced_num_topics}.')
     is_reduced = False
@@ -285,5 +348,29 @@ def default_test(data_name: str = 'crisis_toy'):
     )
 
 
+class TestUtils(unittest.TestCase):
+    def test_expand_deduplicated_model(self):
+        docs = ['a', 'b', 'a', 'c', 'b', 'a']
+        unique_docs, inverse = deduplicate_documents(docs)
+        self.assertTrue(unique_docs == ['a', 'b', 'c'])
+        self.assertTrue(inverse.tolist() == [0, 1, 0, 2, 1, 0])
+
+        # Stub model trained on the unique documents, topic 0 is closest to "b" and topic 1 to "a" and "c"
+        model = Top2Vec.__new__(Top2Vec)
+        model.document_vectors = np.array([[1.0, 0.0], [0.0, 1.0], [0.8, 0.6]])
+        model.topic_vectors = np.array([[0.0, 1.0], [1.0, 0.0]])
+        model.topic_words = np.array([['y'], ['x']])
+        model.topic_word_scores = np.array([[1.0], [1.0]])
+
+        expand_deduplicated_model(model=model, docs=docs, inverse=inverse)
+        self.assertTrue(model.documents.tolist() == docs)
+        self.assertTrue(model.document_ids.tolist() == list(range(len(docs))))
+        self.assertTrue(model.document_vectors.shape == (len(docs), 2))
+        # Topics are reordered by size, so the topic of "a" and "c" (4 documents) comes first
+        self.assertTrue(model.doc_top.tolist() == [0, 1, 0, 0, 1, 0])
+        self.assertTrue(model.topic_sizes.tolist() == [4, 2])
+        self.assertTrue(model.topic_words.tolist() == [['x'], ['y']])
+
+
 if __name__ == '__main__':
     default_test()